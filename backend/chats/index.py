@@ -1,8 +1,72 @@
 import json
 import os
+import re
+import random
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+REPLICA_RETRY_SECONDS = 30
+MAX_REPLICA_LAG_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+# Реплики, отказавшие при подключении или отставшие, пропускаются до указанного момента
+replica_down_until: Dict[str, float] = {}
+
+def connect_for_read(read_after: Optional[str]) -> Any:
+    '''
+    Подключение для чтения: случайная живая реплика из DATABASE_REPLICA_URLS,
+    догнавшая LSN read_after, иначе основная база
+    '''
+    replicas = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+    random.shuffle(replicas)
+    if read_after and not LSN_PATTERN.match(read_after):
+        read_after = None
+    
+    for dsn in replicas:
+        if replica_down_until.get(dsn, 0) > time.monotonic():
+            continue
+        try:
+            conn = psycopg2.connect(dsn, connect_timeout=2)
+        except psycopg2.OperationalError:
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        # Реплика свежая, если последняя применённая транзакция недавняя или
+        # WAL-приёмник подключён к основной базе, всё принятое уже применено
+        # и воспроизведение не на паузе
+        try:
+            with conn.cursor() as cur:
+                cur.execute('''
+                    SELECT
+                        CASE WHEN NOT pg_is_in_recovery() THEN true
+                        ELSE COALESCE(
+                            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) <= %s
+                            OR (
+                                EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+                                AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                                AND NOT pg_is_wal_replay_paused()
+                            ),
+                            false
+                        ) END,
+                        %s IS NULL OR COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) >= %s::pg_lsn
+                ''', (MAX_REPLICA_LAG_SECONDS, read_after, read_after))
+                fresh, caught_up = cur.fetchone()
+        except psycopg2.Error:
+            conn.close()
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if not fresh:
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+        elif caught_up:
+            return conn
+        conn.close()
+    
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+def current_lsn(cur: Any) -> str:
+    cur.execute('SELECT pg_current_wal_lsn()::text AS lsn')
+    return cur.fetchone()['lsn']
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -19,15 +83,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Read-After',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(database_url)
+    if method == 'GET':
+        read_after = event.get('headers', {}).get('x-read-after') or (event.get('queryStringParameters') or {}).get('read_after')
+        conn = connect_for_read(read_after)
+    else:
+        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
     
     try:
         if method == 'GET':
@@ -149,15 +216,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             )
                     
                     conn.commit()
+                    read_after = current_lsn(cur)
                     
                     return {
                         'statusCode': 200,
                         'headers': {
                             'Content-Type': 'application/json',
-                            'Access-Control-Allow-Origin': '*'
+                            'Access-Control-Allow-Origin': '*',
+                            'Access-Control-Expose-Headers': 'X-Read-After',
+                            'X-Read-After': read_after
                         },
                         'isBase64Encoded': False,
-                        'body': json.dumps({'chatId': chat_id, 'groupName': group_name})
+                        'body': json.dumps({'chatId': chat_id, 'groupName': group_name, 'readAfter': read_after})
                     }
                 else:
                     cur.execute('''
@@ -194,15 +264,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     )
                     
                     conn.commit()
+                    read_after = current_lsn(cur)
                     
                     return {
                         'statusCode': 200,
                         'headers': {
                             'Content-Type': 'application/json',
-                            'Access-Control-Allow-Origin': '*'
+                            'Access-Control-Allow-Origin': '*',
+                            'Access-Control-Expose-Headers': 'X-Read-After',
+                            'X-Read-After': read_after
                         },
                         'isBase64Encoded': False,
-                        'body': json.dumps({'chatId': chat_id})
+                        'body': json.dumps({'chatId': chat_id, 'readAfter': read_after})
                     }
         
         return {
@@ -1,8 +1,74 @@
 import json
 import os
+import re
+import random
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+MAX_VARIANT_WIDTH = 4096
+
+REPLICA_RETRY_SECONDS = 30
+MAX_REPLICA_LAG_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+# Реплики, отказавшие при подключении или отставшие, пропускаются до указанного момента
+replica_down_until: Dict[str, float] = {}
+
+def connect_for_read(read_after: Optional[str]) -> Any:
+    '''
+    Подключение для чтения: случайная живая реплика из DATABASE_REPLICA_URLS,
+    догнавшая LSN read_after, иначе основная база
+    '''
+    replicas = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+    random.shuffle(replicas)
+    if read_after and not LSN_PATTERN.match(read_after):
+        read_after = None
+    
+    for dsn in replicas:
+        if replica_down_until.get(dsn, 0) > time.monotonic():
+            continue
+        try:
+            conn = psycopg2.connect(dsn, connect_timeout=2)
+        except psycopg2.OperationalError:
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        # Реплика свежая, если последняя применённая транзакция недавняя или
+        # WAL-приёмник подключён к основной базе, всё принятое уже применено
+        # и воспроизведение не на паузе
+        try:
+            with conn.cursor() as cur:
+                cur.execute('''
+                    SELECT
+                        CASE WHEN NOT pg_is_in_recovery() THEN true
+                        ELSE COALESCE(
+                            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) <= %s
+                            OR (
+                                EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+                                AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                                AND NOT pg_is_wal_replay_paused()
+                            ),
+                            false
+                        ) END,
+                        %s IS NULL OR COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) >= %s::pg_lsn
+                ''', (MAX_REPLICA_LAG_SECONDS, read_after, read_after))
+                fresh, caught_up = cur.fetchone()
+        except psycopg2.Error:
+            conn.close()
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if not fresh:
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+        elif caught_up:
+            return conn
+        conn.close()
+    
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+def current_lsn(cur: Any) -> str:
+    cur.execute('SELECT pg_current_wal_lsn()::text AS lsn')
+    return cur.fetchone()['lsn']
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -19,21 +85,32 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Read-After',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(database_url)
+    if method == 'GET':
+        read_after = event.get('headers', {}).get('x-read-after') or (event.get('queryStringParameters') or {}).get('read_after')
+        conn = connect_for_read(read_after)
+    else:
+        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
     
     try:
         user_id = event.get('headers', {}).get('x-user-id')
         
         if method == 'GET':
+            params = event.get('queryStringParameters') or {}
+            try:
+                max_width = min(max(int(params.get('max_width', MAX_VARIANT_WIDTH)), 1), MAX_VARIANT_WIDTH)
+            except ValueError:
+                max_width = MAX_VARIANT_WIDTH
+            
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Наименьший вариант не уже max_width; если все уже, то 'full', а без
+                # него — исходник, чтобы не отдавать картинку мельче запрошенной
                 cur.execute('''
                     SELECT 
                         m.id,
@@ -47,13 +124,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         m.created_at,
                         u.name as sender_name,
                         u.avatar as sender_avatar,
-                        f.created_at as favorited_at
+                        f.created_at as favorited_at,
+                        mv.media_url as variant_url,
+                        mv.variant as variant_name,
+                        mv.width as variant_width
                     FROM favorites f
                     JOIN messages m ON f.message_id = m.id
                     JOIN users u ON m.sender_id = u.id
+                    LEFT JOIN LATERAL (
+                        SELECT v.media_url, v.variant, v.width
+                        FROM media_variants v
+                        WHERE v.message_id = m.id
+                        ORDER BY v.width < %s, CASE WHEN v.width >= %s THEN v.width END, v.width DESC
+                        LIMIT 1
+                    ) mv ON true
                     WHERE f.user_id = %s
                     ORDER BY f.created_at DESC
-                ''', (user_id,))
+                ''', (max_width, max_width, user_id))
                 
                 favorites = cur.fetchall()
                 
@@ -66,7 +153,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'senderName': fav['sender_name'],
                         'senderAvatar': fav['sender_avatar'],
                         'text': fav['text'],
-                        'mediaUrl': fav['media_url'],
+                        'mediaUrl': fav['variant_url'] if fav['variant_name'] in ('full', 'voice') or (fav['variant_width'] or 0) >= max_width else fav['media_url'],
                         'mediaType': fav['media_type'],
                         'isVoice': fav['is_voice'],
                         'voiceDuration': fav['voice_duration'],
@@ -94,15 +181,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     (user_id, message_id)
                 )
                 conn.commit()
+                read_after = current_lsn(cur)
                 
                 return {
                     'statusCode': 200,
                     'headers': {
                         'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Expose-Headers': 'X-Read-After',
+                        'X-Read-After': read_after
                     },
                     'isBase64Encoded': False,
-                    'body': json.dumps({'success': True})
+                    'body': json.dumps({'success': True, 'readAfter': read_after})
                 }
         
         if method == 'DELETE':
@@ -115,15 +205,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     (user_id, message_id)
                 )
                 conn.commit()
+                read_after = current_lsn(cur)
                 
                 return {
                     'statusCode': 200,
                     'headers': {
                         'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Expose-Headers': 'X-Read-After',
+                        'X-Read-After': read_after
                     },
                     'isBase64Encoded': False,
-                    'body': json.dumps({'success': True})
+                    'body': json.dumps({'success': True, 'readAfter': read_after})
                 }
         
         return {
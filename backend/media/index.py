@@ -0,0 +1,331 @@
+import json
+import os
+import io
+import time
+import base64
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Tuple, Optional
+
+BATCH_SIZE = 8
+MAX_ATTEMPTS = 3
+STALE_LOCK_MINUTES = 10
+IDLE_SLEEP_SECONDS = 2
+# Вызов по таймеру обрабатывает пачки, пока не кончится очередь или этот бюджет
+# (с запасом меньше таймаута функции)
+INVOCATION_BUDGET_SECONDS = 20
+
+# (имя варианта, максимальная сторона в пикселях)
+IMAGE_VARIANTS = [('thumb', 96), ('small', 320), ('medium', 800), ('full', 1600)]
+IMAGE_QUALITY = 80
+
+WAVEFORM_SAMPLES = 64
+WAVEFORM_MAX = 31
+PCM_SAMPLE_RATE = 8000
+VOICE_BITRATE = '16k'
+
+def split_data_url(media_url: str) -> Optional[bytes]:
+    if not media_url or not media_url.startswith('data:') or ',' not in media_url:
+        return None
+    return base64.b64decode(media_url.split(',', 1)[1])
+
+def to_data_url(mime_type: str, data: bytes) -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+
+def process_image(data: bytes) -> Dict[str, Any]:
+    '''
+    Уменьшенные копии изображения в WebP для каждого размера из IMAGE_VARIANTS.
+    Выполняется в дочернем процессе пула
+    '''
+    from PIL import Image, ImageOps
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    longest = max(image.size)
+
+    variants = []
+    for name, size in IMAGE_VARIANTS:
+        # Не увеличиваем картинку; 'full' — перекодированная копия исходного размера
+        if size > longest and name != 'full':
+            continue
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, 'WEBP', quality=IMAGE_QUALITY, method=4)
+        encoded = buffer.getvalue()
+        if len(encoded) >= len(data):
+            continue
+        variants.append({
+            'variant': name,
+            'mediaUrl': to_data_url('image/webp', encoded),
+            'width': resized.width,
+            'height': resized.height,
+            'byteSize': len(encoded)
+        })
+
+    return {'variants': variants}
+
+def run_ffmpeg(args: List[str]) -> bytes:
+    import imageio_ffmpeg
+
+    result = subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), '-v', 'error', '-y'] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=120
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode(errors='replace')[-500:])
+    return result.stdout
+
+def build_waveform(pcm: bytes) -> List[int]:
+    samples = memoryview(pcm[:len(pcm) - len(pcm) % 2]).cast('h')
+    if not samples:
+        return [0] * WAVEFORM_SAMPLES
+
+    chunk = max(1, len(samples) // WAVEFORM_SAMPLES)
+    peaks = []
+    for i in range(WAVEFORM_SAMPLES):
+        window = samples[i * chunk:(i + 1) * chunk]
+        peaks.append(max((abs(s) for s in window), default=0))
+
+    top = max(peaks) or 1
+    return [round(peak * WAVEFORM_MAX / top) for peak in peaks]
+
+def process_voice(data: bytes) -> Dict[str, Any]:
+    '''
+    Проверенная длительность, компактная волна и пережатая Opus-копия
+    голосового сообщения. Выполняется в дочернем процессе пула
+    '''
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'source')
+        compact = os.path.join(workdir, 'compact.webm')
+        with open(source, 'wb') as f:
+            f.write(data)
+
+        pcm = run_ffmpeg(['-i', source, '-ac', '1', '-ar', str(PCM_SAMPLE_RATE), '-f', 's16le', 'pipe:1'])
+        duration = round(len(pcm) / 2 / PCM_SAMPLE_RATE)
+
+        variants = []
+        run_ffmpeg(['-i', source, '-ac', '1', '-c:a', 'libopus', '-b:a', VOICE_BITRATE, '-application', 'voip', compact])
+        with open(compact, 'rb') as f:
+            encoded = f.read()
+        if len(encoded) < len(data):
+            variants.append({
+                'variant': 'voice',
+                'mediaUrl': to_data_url('audio/webm', encoded),
+                'width': None,
+                'height': None,
+                'byteSize': len(encoded)
+            })
+
+    return {
+        'variants': variants,
+        'duration': max(1, duration) if pcm else 0,
+        'waveform': build_waveform(pcm)
+    }
+
+def claim_jobs(conn: Any) -> List[Dict[str, Any]]:
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # Задача, которая уже MAX_ATTEMPTS раз роняла или вешала воркер, больше не берётся
+        cur.execute('''
+            UPDATE media_jobs
+            SET status = 'failed', locked_at = NULL, last_error = 'Worker did not finish the job'
+            WHERE status = 'processing'
+            AND locked_at < NOW() - make_interval(mins => %s)
+            AND attempts >= %s
+        ''', (STALE_LOCK_MINUTES, MAX_ATTEMPTS))
+        cur.execute('''
+            UPDATE media_jobs
+            SET status = 'processing', locked_at = NOW(), attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM media_jobs
+                WHERE (status = 'pending' AND run_after <= NOW())
+                OR (status = 'processing' AND locked_at < NOW() - make_interval(mins => %s) AND attempts < %s)
+                ORDER BY id ASC
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, message_id, kind, attempts
+        ''', (STALE_LOCK_MINUTES, MAX_ATTEMPTS, BATCH_SIZE))
+        jobs = cur.fetchall()
+        conn.commit()
+        return jobs
+
+def load_media(conn: Any, message_ids: List[int]) -> Dict[int, Optional[str]]:
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute('SELECT id, media_url FROM messages WHERE id = ANY(%s)', (message_ids,))
+        return {row['id']: row['media_url'] for row in cur.fetchall()}
+
+def save_result(conn: Any, job: Dict[str, Any], result: Dict[str, Any]) -> None:
+    with conn.cursor() as cur:
+        for variant in result['variants']:
+            cur.execute('''
+                INSERT INTO media_variants (message_id, variant, media_url, width, height, byte_size)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (message_id, variant) DO UPDATE SET
+                    media_url = EXCLUDED.media_url,
+                    width = EXCLUDED.width,
+                    height = EXCLUDED.height,
+                    byte_size = EXCLUDED.byte_size
+            ''', (job['message_id'], variant['variant'], variant['mediaUrl'],
+                  variant['width'], variant['height'], variant['byteSize']))
+
+        if job['kind'] == 'voice':
+            cur.execute(
+                'UPDATE messages SET voice_duration = %s, voice_waveform = %s WHERE id = %s',
+                (result['duration'], result['waveform'], job['message_id'])
+            )
+
+        # Клиенты синхронизации получат сообщение повторно уже с готовым медиа
+        cur.execute(
+            "INSERT INTO change_log (kind, chat_id, entity_id) SELECT 'media_ready', chat_id, id FROM messages WHERE id = %s",
+            (job['message_id'],)
+        )
+        cur.execute(
+            "UPDATE media_jobs SET status = 'done', locked_at = NULL, last_error = NULL WHERE id = %s",
+            (job['id'],)
+        )
+    conn.commit()
+
+def save_failure(conn: Any, job: Dict[str, Any], error: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute('''
+            UPDATE media_jobs
+            SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                run_after = NOW() + make_interval(mins => attempts),
+                locked_at = NULL,
+                last_error = %s
+            WHERE id = %s
+        ''', (MAX_ATTEMPTS, error[:1000], job['id']))
+    conn.commit()
+
+def release_job(conn: Any, job: Dict[str, Any]) -> None:
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE media_jobs SET status = 'pending', locked_at = NULL, attempts = attempts - 1 WHERE id = %s",
+            (job['id'],)
+        )
+    conn.commit()
+
+def process_batch(conn: Any, pool: ProcessPoolExecutor) -> Tuple[int, int, bool]:
+    '''
+    Обрабатывает одну пачку задач. Третье значение — пул сломан падением
+    дочернего процесса и его нужно пересоздать
+    '''
+    jobs = claim_jobs(conn)
+    if not jobs:
+        return 0, 0, False
+
+    media = load_media(conn, [job['message_id'] for job in jobs])
+    futures = []
+    broken = False
+    for job in jobs:
+        if broken:
+            futures.append((job, None, None))
+            continue
+        try:
+            data = split_data_url(media.get(job['message_id']))
+            if not data:
+                raise ValueError('Media is not an inline data URL')
+            worker = process_image if job['kind'] == 'image' else process_voice
+            futures.append((job, pool.submit(worker, data), None))
+        except BrokenProcessPool:
+            broken = True
+            futures.append((job, None, None))
+        except Exception as error:
+            futures.append((job, None, error))
+
+    done = failed = 0
+    for job, future, error in futures:
+        if future is None and error is None:
+            # Пул сломался до отправки задачи: вернуть её в очередь без штрафа
+            release_job(conn, job)
+            continue
+        try:
+            if error is not None:
+                raise error
+            save_result(conn, job, future.result())
+            done += 1
+        except Exception as error:
+            if isinstance(error, BrokenProcessPool):
+                broken = True
+            conn.rollback()
+            save_failure(conn, job, f'{type(error).__name__}: {error}')
+            failed += 1
+    return done, failed, broken
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Фоновая обработка медиа из очереди media_jobs — превью изображений, длительность и волна голосовых
+    Args: event - dict с httpMethod (вызов по таймеру или POST)
+          context - object с атрибутами request_id, function_name
+    Returns: HTTP response dict с количеством обработанных и неудачных задач
+    '''
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(database_url)
+
+    try:
+        deadline = time.monotonic() + INVOCATION_BUDGET_SECONDS
+        done = failed = 0
+        pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        try:
+            while time.monotonic() < deadline:
+                batch_done, batch_failed, broken = process_batch(conn, pool)
+                done += batch_done
+                failed += batch_failed
+                if broken:
+                    pool.shutdown(wait=False)
+                    pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+                elif not batch_done and not batch_failed:
+                    break
+        finally:
+            pool.shutdown(wait=False)
+
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'processed': done, 'failed': failed})
+        }
+
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    try:
+        while True:
+            done, failed, broken = process_batch(conn, pool)
+            if broken:
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+            elif not done and not failed:
+                time.sleep(IDLE_SLEEP_SECONDS)
+    finally:
+        pool.shutdown(wait=False)
+        conn.close()
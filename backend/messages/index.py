@@ -1,8 +1,187 @@
 import json
 import os
+import re
+import random
+import math
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple, Optional
+
+MAX_BODY_BYTES = 7 * 1024 * 1024
+MAX_MEDIA_BYTES = 5 * 1024 * 1024
+MAX_TEXT_LENGTH = 4096
+MAX_VARIANT_WIDTH = 4096
+
+# (ёмкость, пополнение токенов в секунду)
+USER_SEND_LIMIT = (20, 1.0)
+CHAT_SEND_LIMIT = (60, 5.0)
+
+# Простаивающая дольше этого корзина заведомо полна и равносильна отсутствующей
+BUCKET_IDLE_SECONDS = 3600
+LOCAL_BUCKETS_MAX = 10000
+BUCKET_CLEANUP_PROBABILITY = 0.01
+
+REPLICA_RETRY_SECONDS = 30
+MAX_REPLICA_LAG_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+# Реплики, отказавшие при подключении или отставшие, пропускаются до указанного момента
+replica_down_until: Dict[str, float] = {}
+
+# Локальные корзины живут между вызовами в прогретом контейнере. Локальный
+# расход — подмножество общего, поэтому пустая локальная корзина гарантирует
+# пустую общую и позволяет отказать без обращения к БД
+local_buckets: Dict[str, Tuple[float, float]] = {}
+
+def take_local_tokens(buckets: List[Tuple[str, Tuple[int, float]]]) -> float:
+    now = time.monotonic()
+    if len(local_buckets) > LOCAL_BUCKETS_MAX:
+        for key in [k for k, (_, updated_at) in local_buckets.items() if now - updated_at > BUCKET_IDLE_SECONDS]:
+            del local_buckets[key]
+    
+    refilled = {}
+    retry_after = 0.0
+    for key, (capacity, rate) in buckets:
+        tokens, updated_at = local_buckets.get(key, (float(capacity), now))
+        refilled[key] = min(capacity, tokens + (now - updated_at) * rate)
+        if refilled[key] < 1:
+            retry_after = max(retry_after, (1 - refilled[key]) / rate)
+
+    for key, tokens in refilled.items():
+        local_buckets[key] = (tokens if retry_after > 0 else tokens - 1, now)
+    return retry_after
+
+def refund_local_token(key: str, limit: Tuple[int, float]) -> None:
+    if key in local_buckets:
+        tokens, updated_at = local_buckets[key]
+        local_buckets[key] = (min(limit[0], tokens + 1), updated_at)
+
+def take_shared_token(cur: Any, key: str, limit: Tuple[int, float]) -> float:
+    capacity, rate = limit
+    cur.execute('''
+        INSERT INTO rate_limit_buckets (bucket_key, tokens, updated_at)
+        VALUES (%s, %s, clock_timestamp())
+        ON CONFLICT (bucket_key) DO UPDATE SET
+            tokens = LEAST(%s, rate_limit_buckets.tokens
+                + EXTRACT(EPOCH FROM clock_timestamp() - rate_limit_buckets.updated_at) * %s) - 1,
+            updated_at = clock_timestamp()
+        WHERE LEAST(%s, rate_limit_buckets.tokens
+            + EXTRACT(EPOCH FROM clock_timestamp() - rate_limit_buckets.updated_at) * %s) >= 1
+        RETURNING tokens
+    ''', (key, capacity - 1, capacity, rate, capacity, rate))
+    granted = cur.fetchone()
+    now = time.monotonic()
+
+    if granted:
+        tokens, _ = local_buckets.get(key, (float(capacity), now))
+        local_buckets[key] = (min(tokens, granted['tokens']), now)
+        return 0.0
+
+    cur.execute('''
+        SELECT LEAST(%s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * %s) AS tokens
+        FROM rate_limit_buckets
+        WHERE bucket_key = %s
+    ''', (capacity, rate, key))
+    tokens = cur.fetchone()['tokens']
+    local_buckets[key] = (tokens, now)
+    return (1 - tokens) / rate
+
+def delete_idle_shared_buckets(cur: Any) -> None:
+    cur.execute(
+        'DELETE FROM rate_limit_buckets WHERE updated_at < NOW() - make_interval(secs => %s)',
+        (BUCKET_IDLE_SECONDS,)
+    )
+
+def rate_limited_response(retry_after: float) -> Dict[str, Any]:
+    seconds = max(1, math.ceil(retry_after))
+    return {
+        'statusCode': 429,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'Retry-After',
+            'Retry-After': str(seconds)
+        },
+        'isBase64Encoded': False,
+        'body': json.dumps({'error': 'Too many messages', 'retryAfter': seconds})
+    }
+
+def bad_request_response(error: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 400,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'isBase64Encoded': False,
+        'body': json.dumps({'error': error})
+    }
+
+def payload_too_large_response() -> Dict[str, Any]:
+    return {
+        'statusCode': 413,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'isBase64Encoded': False,
+        'body': json.dumps({'error': 'Payload too large'})
+    }
+
+def connect_for_read(read_after: Optional[str]) -> Any:
+    '''
+    Подключение для чтения: случайная живая реплика из DATABASE_REPLICA_URLS,
+    догнавшая LSN read_after, иначе основная база
+    '''
+    replicas = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+    random.shuffle(replicas)
+    if read_after and not LSN_PATTERN.match(read_after):
+        read_after = None
+    
+    for dsn in replicas:
+        if replica_down_until.get(dsn, 0) > time.monotonic():
+            continue
+        try:
+            conn = psycopg2.connect(dsn, connect_timeout=2)
+        except psycopg2.OperationalError:
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        # Реплика свежая, если последняя применённая транзакция недавняя или
+        # WAL-приёмник подключён к основной базе, всё принятое уже применено
+        # и воспроизведение не на паузе
+        try:
+            with conn.cursor() as cur:
+                cur.execute('''
+                    SELECT
+                        CASE WHEN NOT pg_is_in_recovery() THEN true
+                        ELSE COALESCE(
+                            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) <= %s
+                            OR (
+                                EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+                                AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                                AND NOT pg_is_wal_replay_paused()
+                            ),
+                            false
+                        ) END,
+                        %s IS NULL OR COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) >= %s::pg_lsn
+                ''', (MAX_REPLICA_LAG_SECONDS, read_after, read_after))
+                fresh, caught_up = cur.fetchone()
+        except psycopg2.Error:
+            conn.close()
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if not fresh:
+            replica_down_until[dsn] = time.monotonic() + REPLICA_RETRY_SECONDS
+        elif caught_up:
+            return conn
+        conn.close()
+    
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+def current_lsn(cur: Any) -> str:
+    cur.execute('SELECT pg_current_wal_lsn()::text AS lsn')
+    return cur.fetchone()['lsn']
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -19,23 +198,69 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Read-After',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    database_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(database_url)
+    if method == 'POST':
+        raw_body = event.get('body') or '{}'
+        if len(raw_body) > MAX_BODY_BYTES:
+            return payload_too_large_response()
+
+        try:
+            body_data = json.loads(raw_body)
+        except ValueError:
+            return bad_request_response('Invalid message body')
+        if not isinstance(body_data, dict):
+            return bad_request_response('Invalid message body')
+        for field in ('text', 'mediaFile', 'mediaUrl', 'mediaType'):
+            if body_data.get(field) is not None and not isinstance(body_data.get(field), str):
+                return bad_request_response(f'Field {field} must be a string')
+        
+        media_file = body_data.get('mediaFile')
+        inline_media = body_data.get('mediaUrl') or ''
+        inline_media = inline_media.split(',', 1)[-1] if inline_media.startswith('data:') else ''
+        if len(body_data.get('text') or '') > MAX_TEXT_LENGTH:
+            return payload_too_large_response()
+        if len(media_file or inline_media) * 3 // 4 > MAX_MEDIA_BYTES:
+            return payload_too_large_response()
+
+        try:
+            sender_id = int(event.get('headers', {}).get('x-user-id'))
+            chat_id = int(body_data.get('chatId'))
+        except (TypeError, ValueError):
+            return bad_request_response('Invalid user or chat id')
+
+        send_buckets = [
+            (f"user:{sender_id}", USER_SEND_LIMIT),
+            (f"chat:{chat_id}", CHAT_SEND_LIMIT)
+        ]
+        retry_after = take_local_tokens(send_buckets)
+        if retry_after > 0:
+            return rate_limited_response(retry_after)
+    
+    if method == 'GET':
+        read_after = event.get('headers', {}).get('x-read-after') or (event.get('queryStringParameters') or {}).get('read_after')
+        conn = connect_for_read(read_after)
+    else:
+        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
     
     try:
         if method == 'GET':
             params = event.get('queryStringParameters', {})
             chat_id = params.get('chat_id')
             user_id = event.get('headers', {}).get('x-user-id')
+            try:
+                max_width = min(max(int(params.get('max_width', MAX_VARIANT_WIDTH)), 1), MAX_VARIANT_WIDTH)
+            except ValueError:
+                max_width = MAX_VARIANT_WIDTH
             
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Наименьший вариант не уже max_width; если все уже, то 'full', а без
+                # него — исходник, чтобы не отдавать картинку мельче запрошенной
                 cur.execute('''
                     SELECT 
                         m.id,
@@ -44,14 +269,27 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         m.text,
                         m.media_url,
                         m.media_type,
+                        m.is_voice,
+                        m.voice_duration,
+                        m.voice_waveform,
                         m.created_at,
                         u.name as sender_name,
-                        u.avatar as sender_avatar
+                        u.avatar as sender_avatar,
+                        mv.media_url as variant_url,
+                        mv.variant as variant_name,
+                        mv.width as variant_width
                     FROM messages m
                     JOIN users u ON m.sender_id = u.id
+                    LEFT JOIN LATERAL (
+                        SELECT v.media_url, v.variant, v.width
+                        FROM media_variants v
+                        WHERE v.message_id = m.id
+                        ORDER BY v.width < %s, CASE WHEN v.width >= %s THEN v.width END, v.width DESC
+                        LIMIT 1
+                    ) mv ON true
                     WHERE m.chat_id = %s
                     ORDER BY m.created_at ASC
-                ''', (chat_id,))
+                ''', (max_width, max_width, chat_id))
                 
                 messages = cur.fetchall()
                 
@@ -64,8 +302,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'senderName': msg['sender_name'],
                         'senderAvatar': msg['sender_avatar'],
                         'text': msg['text'],
-                        'mediaUrl': msg['media_url'],
+                        'mediaUrl': msg['variant_url'] if msg['variant_name'] in ('full', 'voice') or (msg['variant_width'] or 0) >= max_width else msg['media_url'],
                         'mediaType': msg['media_type'],
+                        'isVoice': msg['is_voice'],
+                        'voiceDuration': msg['voice_duration'],
+                        'voiceWaveform': msg['voice_waveform'],
                         'time': msg['created_at'].strftime('%H:%M'),
                         'isOwn': str(msg['sender_id']) == str(user_id)
                     })
@@ -81,21 +322,32 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
         
         if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            chat_id = body_data.get('chatId')
-            sender_id = event.get('headers', {}).get('x-user-id')
             text = body_data.get('text', '')
             media_url = body_data.get('mediaUrl')
             media_type = body_data.get('mediaType')
             is_voice = body_data.get('isVoice', False)
             voice_duration = body_data.get('voiceDuration')
-            media_file = body_data.get('mediaFile')
             
             if media_file and not media_url:
                 import uuid
                 file_id = str(uuid.uuid4())
                 media_url = f"data:{media_type};base64,{media_file}"
             
+            # Токены списываются в отдельной короткой транзакции, чтобы блокировки
+            # корзин не держались на время вставки тяжёлого сообщения
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                for key, limit in send_buckets:
+                    retry_after = take_shared_token(cur, key, limit)
+                    if retry_after > 0:
+                        conn.rollback()
+                        for other_key, other_limit in send_buckets:
+                            if other_key != key:
+                                refund_local_token(other_key, other_limit)
+                        return rate_limited_response(retry_after)
+                if random.random() < BUCKET_CLEANUP_PROBABILITY:
+                    delete_idle_shared_buckets(cur)
+                conn.commit()
+            
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute('''
                     INSERT INTO messages (chat_id, sender_id, text, media_url, media_type, is_voice, voice_duration)
@@ -104,7 +356,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 ''', (chat_id, sender_id, text, media_url, media_type, is_voice, voice_duration))
                 
                 message = cur.fetchone()
+                
+                media_job_kind = 'voice' if is_voice else 'image' if media_type == 'image' else None
+                if media_job_kind and media_url and media_url.startswith('data:'):
+                    cur.execute(
+                        'INSERT INTO media_jobs (message_id, kind) VALUES (%s, %s)',
+                        (message['id'], media_job_kind)
+                    )
+                
                 conn.commit()
+                read_after = current_lsn(cur)
                 
                 cur.execute('SELECT name, avatar FROM users WHERE id = %s', (sender_id,))
                 user = cur.fetchone()
@@ -113,10 +374,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'statusCode': 200,
                     'headers': {
                         'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Expose-Headers': 'X-Read-After',
+                        'X-Read-After': read_after
                     },
                     'isBase64Encoded': False,
                     'body': json.dumps({
+                        'readAfter': read_after,
                         'message': {
                             'id': message['id'],
                             'chatId': message['chat_id'],
@@ -0,0 +1,444 @@
+import json
+import os
+import base64
+import random
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Tuple, Optional
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+CHANGE_LOG_RETENTION_DAYS = 30
+CHANGE_LOG_CLEANUP_PROBABILITY = 0.01
+
+# Медиа в синхронизации: вариант размером с пузырь сообщения или голосовой,
+# исходник — только если он маленький, иначе NULL до события media_ready
+SYNC_MEDIA_SIZE = 320
+SYNC_INLINE_MEDIA_BYTES = 64 * 1024
+SYNC_MEDIA_URL_SQL = '''
+    COALESCE(
+        (
+            SELECT v.media_url
+            FROM media_variants v
+            WHERE v.message_id = m.id
+            AND (v.variant = 'voice' OR GREATEST(v.width, v.height) <= %(media_size)s)
+            ORDER BY v.width DESC NULLS FIRST
+            LIMIT 1
+        ),
+        CASE
+            WHEN left(m.media_url, 5) != 'data:' OR length(m.media_url) <= %(inline_bytes)s THEN m.media_url
+        END
+    ) as media_url'''
+
+def encode_token(tx_id: int, seq: int) -> str:
+    raw = f'{tx_id}:{seq}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_token(token: str) -> Optional[Tuple[int, int]]:
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        tx_id, seq = base64.urlsafe_b64decode(padded.encode()).decode().split(':')
+        return int(tx_id), int(seq)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def prune_change_log(conn: Any) -> None:
+    '''
+    Удаляет старые записи журнала и сдвигает горизонт: токены до него
+    получают reset вместо пролистывания неполной истории
+    '''
+    with conn.cursor() as cur:
+        cur.execute('''
+            WITH pruned AS (
+                DELETE FROM change_log
+                WHERE created_at < NOW() - make_interval(days => %s)
+                RETURNING tx_id, seq
+            )
+            UPDATE change_log_horizon h
+            SET tx_id = p.tx_id, seq = p.seq
+            FROM (SELECT tx_id, seq FROM pruned ORDER BY tx_id DESC, seq DESC LIMIT 1) p
+            WHERE (p.tx_id, p.seq) > (h.tx_id, h.seq)
+        ''', (CHANGE_LOG_RETENTION_DAYS,))
+    conn.commit()
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Дельта-синхронизация всех чатов пользователя по одному токену
+    Args: event - dict с httpMethod, queryStringParameters (token, limit)
+          context - object с атрибутами request_id, function_name
+    Returns: HTTP response dict с изменениями после токена и новым syncToken
+    '''
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'GET':
+        return {
+            'statusCode': 405,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': 'Method not allowed'})
+        }
+
+    params = event.get('queryStringParameters') or {}
+    user_id = event.get('headers', {}).get('x-user-id')
+    token = params.get('token', '')
+
+    try:
+        limit = min(max(int(params.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+
+    position = decode_token(token) if token else None
+    if token and position is None:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': 'Invalid sync token'})
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(database_url)
+
+    try:
+        if random.random() < CHANGE_LOG_CLEANUP_PROBABILITY:
+            prune_change_log(conn)
+        
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # Отдаём только строки завершённых транзакций: всё, что ещё может
+            # закоммититься, имеет tx_id >= xmin и попадёт в следующую выборку
+            cur.execute('SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin')
+            xmin = cur.fetchone()['xmin']
+
+            cur.execute('SELECT tx_id, seq FROM change_log_horizon')
+            horizon = cur.fetchone()
+
+            if position is None or position < (horizon['tx_id'], horizon['seq']):
+                return {
+                    'statusCode': 200,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'isBase64Encoded': False,
+                    'body': json.dumps({
+                        'reset': True,
+                        'hasMore': False,
+                        'syncToken': encode_token(xmin, 0)
+                    })
+                }
+
+            # Три ветки по своим индексам вместо одного OR по всему журналу:
+            # события чатов пользователя, его личные события и присутствие
+            # только тех, с кем у него есть общий чат
+            cur.execute('''
+                (
+                    SELECT cl.seq, cl.tx_id, cl.kind, cl.chat_id, cl.user_id, cl.entity_id
+                    FROM chat_members cm
+                    JOIN change_log cl ON cl.chat_id = cm.chat_id
+                    WHERE cm.user_id = %(user_id)s
+                    AND (cl.tx_id, cl.seq) > (%(tx_id)s, %(seq)s)
+                    AND cl.tx_id < %(xmin)s
+                    ORDER BY cl.tx_id, cl.seq
+                    LIMIT %(limit)s
+                )
+                UNION
+                (
+                    SELECT cl.seq, cl.tx_id, cl.kind, cl.chat_id, cl.user_id, cl.entity_id
+                    FROM change_log cl
+                    WHERE cl.user_id = %(user_id)s
+                    AND (cl.tx_id, cl.seq) > (%(tx_id)s, %(seq)s)
+                    AND cl.tx_id < %(xmin)s
+                    ORDER BY cl.tx_id, cl.seq
+                    LIMIT %(limit)s
+                )
+                UNION
+                (
+                    SELECT cl.seq, cl.tx_id, cl.kind, cl.chat_id, cl.user_id, cl.entity_id
+                    FROM change_log cl
+                    WHERE cl.kind = 'presence'
+                    AND cl.entity_id IN (
+                        SELECT cm2.user_id
+                        FROM chat_members cm1
+                        JOIN chat_members cm2 ON cm2.chat_id = cm1.chat_id
+                        WHERE cm1.user_id = %(user_id)s AND cm2.user_id != %(user_id)s
+                    )
+                    AND (cl.tx_id, cl.seq) > (%(tx_id)s, %(seq)s)
+                    AND cl.tx_id < %(xmin)s
+                    ORDER BY cl.tx_id, cl.seq
+                    LIMIT %(limit)s
+                )
+                ORDER BY tx_id, seq
+                LIMIT %(limit)s
+            ''', {
+                'user_id': user_id,
+                'tx_id': position[0],
+                'seq': position[1],
+                'xmin': xmin,
+                'limit': limit + 1
+            })
+
+            changes = cur.fetchall()
+            has_more = len(changes) > limit
+            changes = changes[:limit]
+
+            if changes:
+                last = changes[-1]
+                next_position = (last['tx_id'], last['seq'])
+            else:
+                next_position = position
+            if not has_more and next_position < (xmin, 0):
+                next_position = (xmin, 0)
+
+            message_ids: List[int] = []
+            joined_chat_ids: List[int] = []
+            left_chat_ids: List[int] = []
+            member_chat_ids: List[int] = []
+            favorite_state: Dict[int, bool] = {}
+            presence_ids: List[int] = []
+
+            for change in changes:
+                kind = change['kind']
+                if kind in ('message', 'media_ready'):
+                    if change['entity_id'] not in message_ids:
+                        message_ids.append(change['entity_id'])
+                elif kind in ('chat_join', 'chat_leave'):
+                    if str(change['user_id']) == str(user_id):
+                        target = joined_chat_ids if kind == 'chat_join' else left_chat_ids
+                        other = left_chat_ids if kind == 'chat_join' else joined_chat_ids
+                        if change['chat_id'] in other:
+                            other.remove(change['chat_id'])
+                        if change['chat_id'] not in target:
+                            target.append(change['chat_id'])
+                    elif change['chat_id'] not in member_chat_ids:
+                        member_chat_ids.append(change['chat_id'])
+                elif kind in ('favorite_add', 'favorite_remove'):
+                    favorite_state.pop(change['entity_id'], None)
+                    favorite_state[change['entity_id']] = kind == 'favorite_add'
+                elif kind == 'presence' and change['entity_id'] not in presence_ids:
+                    presence_ids.append(change['entity_id'])
+
+            messages = []
+            if message_ids:
+                cur.execute('''
+                    SELECT
+                        m.id,
+                        m.chat_id,
+                        m.sender_id,
+                        m.text,''' + SYNC_MEDIA_URL_SQL + ''',
+                        m.media_type,
+                        m.is_voice,
+                        m.voice_duration,
+                        m.voice_waveform,
+                        m.created_at,
+                        u.name as sender_name,
+                        u.avatar as sender_avatar
+                    FROM messages m
+                    JOIN users u ON m.sender_id = u.id
+                    WHERE m.id = ANY(%(message_ids)s)
+                    ORDER BY m.created_at ASC, m.id ASC
+                ''', {
+                    'message_ids': message_ids,
+                    'media_size': SYNC_MEDIA_SIZE,
+                    'inline_bytes': SYNC_INLINE_MEDIA_BYTES
+                })
+
+                for msg in cur.fetchall():
+                    messages.append({
+                        'id': msg['id'],
+                        'chatId': msg['chat_id'],
+                        'senderId': msg['sender_id'],
+                        'senderName': msg['sender_name'],
+                        'senderAvatar': msg['sender_avatar'],
+                        'text': msg['text'],
+                        'mediaUrl': msg['media_url'],
+                        'mediaType': msg['media_type'],
+                        'isVoice': msg['is_voice'],
+                        'voiceDuration': msg['voice_duration'],
+                        'voiceWaveform': msg['voice_waveform'],
+                        'time': msg['created_at'].strftime('%H:%M'),
+                        'isOwn': str(msg['sender_id']) == str(user_id)
+                    })
+
+            joined_chats = []
+            if joined_chat_ids:
+                cur.execute('''
+                    SELECT DISTINCT
+                        c.id,
+                        c.name,
+                        c.is_group,
+                        c.is_global,
+                        (
+                            SELECT u2.id 
+                            FROM chat_members cm2 
+                            JOIN users u2 ON cm2.user_id = u2.id
+                            WHERE cm2.chat_id = c.id AND cm2.user_id != %(user_id)s
+                            LIMIT 1
+                        ) as other_user_id,
+                        (
+                            SELECT u2.name 
+                            FROM chat_members cm2 
+                            JOIN users u2 ON cm2.user_id = u2.id
+                            WHERE cm2.chat_id = c.id AND cm2.user_id != %(user_id)s
+                            LIMIT 1
+                        ) as other_user_name,
+                        (
+                            SELECT u2.avatar 
+                            FROM chat_members cm2 
+                            JOIN users u2 ON cm2.user_id = u2.id
+                            WHERE cm2.chat_id = c.id AND cm2.user_id != %(user_id)s
+                            LIMIT 1
+                        ) as other_user_avatar,
+                        (
+                            SELECT u2.online 
+                            FROM chat_members cm2 
+                            JOIN users u2 ON cm2.user_id = u2.id
+                            WHERE cm2.chat_id = c.id AND cm2.user_id != %(user_id)s
+                            LIMIT 1
+                        ) as other_user_online,
+                        (
+                            SELECT m.text
+                            FROM messages m
+                            WHERE m.chat_id = c.id
+                            ORDER BY m.created_at DESC
+                            LIMIT 1
+                        ) as last_message,
+                        (
+                            SELECT m.created_at
+                            FROM messages m
+                            WHERE m.chat_id = c.id
+                            ORDER BY m.created_at DESC
+                            LIMIT 1
+                        ) as last_message_time
+                    FROM chats c
+                    JOIN chat_members cm ON c.id = cm.chat_id
+                    WHERE cm.user_id = %(user_id)s AND c.id = ANY(%(chat_ids)s)
+                    ORDER BY last_message_time DESC NULLS LAST
+                ''', {'user_id': user_id, 'chat_ids': joined_chat_ids})
+
+                for chat in cur.fetchall():
+                    joined_chats.append({
+                        'id': chat['id'],
+                        'name': chat['name'] or chat['other_user_name'] or 'Чат',
+                        'isGroup': chat['is_group'],
+                        'isGlobal': chat['is_global'],
+                        'user': {
+                            'id': chat['other_user_id'],
+                            'name': chat['other_user_name'],
+                            'avatar': chat['other_user_avatar'],
+                            'online': chat['other_user_online']
+                        } if not chat['is_group'] else None,
+                        'lastMessage': chat['last_message'] or '',
+                        'time': chat['last_message_time'].strftime('%H:%M') if chat['last_message_time'] else '',
+                        'unread': 0
+                    })
+
+            added_favorite_ids = [mid for mid, added in favorite_state.items() if added]
+            removed_favorite_ids = [mid for mid, added in favorite_state.items() if not added]
+            added_favorites = []
+            if added_favorite_ids:
+                cur.execute('''
+                    SELECT
+                        m.id,
+                        m.chat_id,
+                        m.sender_id,
+                        m.text,''' + SYNC_MEDIA_URL_SQL + ''',
+                        m.media_type,
+                        m.is_voice,
+                        m.voice_duration,
+                        m.created_at,
+                        u.name as sender_name,
+                        u.avatar as sender_avatar,
+                        f.created_at as favorited_at
+                    FROM favorites f
+                    JOIN messages m ON f.message_id = m.id
+                    JOIN users u ON m.sender_id = u.id
+                    WHERE f.user_id = %(user_id)s AND f.message_id = ANY(%(message_ids)s)
+                    ORDER BY f.created_at DESC
+                ''', {
+                    'user_id': user_id,
+                    'message_ids': added_favorite_ids,
+                    'media_size': SYNC_MEDIA_SIZE,
+                    'inline_bytes': SYNC_INLINE_MEDIA_BYTES
+                })
+
+                for fav in cur.fetchall():
+                    added_favorites.append({
+                        'id': fav['id'],
+                        'chatId': fav['chat_id'],
+                        'senderId': fav['sender_id'],
+                        'senderName': fav['sender_name'],
+                        'senderAvatar': fav['sender_avatar'],
+                        'text': fav['text'],
+                        'mediaUrl': fav['media_url'],
+                        'mediaType': fav['media_type'],
+                        'isVoice': fav['is_voice'],
+                        'voiceDuration': fav['voice_duration'],
+                        'time': fav['created_at'].strftime('%H:%M'),
+                        'favoritedAt': fav['favorited_at'].strftime('%d.%m.%Y %H:%M')
+                    })
+
+            presence = []
+            if presence_ids:
+                cur.execute('''
+                    SELECT id, name, avatar, online, last_seen
+                    FROM users
+                    WHERE id = ANY(%s) AND id != %s
+                    ORDER BY id ASC
+                ''', (presence_ids, user_id))
+
+                for user in cur.fetchall():
+                    presence.append({
+                        'id': user['id'],
+                        'name': user['name'],
+                        'avatar': user['avatar'],
+                        'online': user['online'],
+                        'lastSeen': user['last_seen'].strftime('%d.%m.%Y %H:%M') if user['last_seen'] else None
+                    })
+
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({
+                    'reset': False,
+                    'hasMore': has_more,
+                    'syncToken': encode_token(*next_position),
+                    'messages': messages,
+                    'chats': {
+                        'joined': joined_chats,
+                        'left': left_chat_ids,
+                        'membersChanged': member_chat_ids
+                    },
+                    'favorites': {
+                        'added': added_favorites,
+                        'removed': removed_favorite_ids
+                    },
+                    'presence': presence
+                })
+            }
+
+    finally:
+        conn.close()
@@ -0,0 +1,76 @@
+-- Журнал изменений для дельта-синхронизации (функция sync)
+-- chat_id заполнен для событий чата, user_id — для личных событий пользователя,
+-- оба NULL — широковещательные события (присутствие)
+CREATE TABLE IF NOT EXISTS change_log (
+    seq BIGSERIAL PRIMARY KEY,
+    tx_id BIGINT NOT NULL DEFAULT txid_current(),
+    kind VARCHAR(20) NOT NULL,
+    chat_id INTEGER,
+    user_id INTEGER,
+    entity_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_change_log_tx_seq ON change_log(tx_id, seq);
+CREATE INDEX IF NOT EXISTS idx_change_log_chat ON change_log(chat_id, tx_id, seq);
+CREATE INDEX IF NOT EXISTS idx_change_log_user ON change_log(user_id, tx_id, seq);
+
+CREATE OR REPLACE FUNCTION log_message_change() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO change_log (kind, chat_id, entity_id) VALUES ('message', NEW.chat_id, NEW.id);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION log_chat_member_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO change_log (kind, chat_id, user_id, entity_id) VALUES ('chat_join', NEW.chat_id, NEW.user_id, NEW.chat_id);
+        RETURN NEW;
+    END IF;
+    INSERT INTO change_log (kind, chat_id, user_id, entity_id) VALUES ('chat_leave', OLD.chat_id, OLD.user_id, OLD.chat_id);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION log_favorite_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO change_log (kind, user_id, entity_id) VALUES ('favorite_add', NEW.user_id, NEW.message_id);
+        RETURN NEW;
+    END IF;
+    INSERT INTO change_log (kind, user_id, entity_id) VALUES ('favorite_remove', OLD.user_id, OLD.message_id);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION log_presence_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.online IS DISTINCT FROM OLD.online
+        OR NEW.name IS DISTINCT FROM OLD.name
+        OR NEW.avatar IS DISTINCT FROM OLD.avatar THEN
+        INSERT INTO change_log (kind, entity_id) VALUES ('presence', NEW.id);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_change_log ON messages;
+CREATE TRIGGER trg_messages_change_log
+    AFTER INSERT ON messages
+    FOR EACH ROW EXECUTE FUNCTION log_message_change();
+
+DROP TRIGGER IF EXISTS trg_chat_members_change_log ON chat_members;
+CREATE TRIGGER trg_chat_members_change_log
+    AFTER INSERT OR DELETE ON chat_members
+    FOR EACH ROW EXECUTE FUNCTION log_chat_member_change();
+
+DROP TRIGGER IF EXISTS trg_favorites_change_log ON favorites;
+CREATE TRIGGER trg_favorites_change_log
+    AFTER INSERT OR DELETE ON favorites
+    FOR EACH ROW EXECUTE FUNCTION log_favorite_change();
+
+DROP TRIGGER IF EXISTS trg_users_presence_change_log ON users;
+CREATE TRIGGER trg_users_presence_change_log
+    AFTER UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION log_presence_change();
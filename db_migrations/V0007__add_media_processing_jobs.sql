@@ -0,0 +1,31 @@
+-- Очередь фоновой обработки медиа и готовые варианты файлов
+CREATE TABLE IF NOT EXISTS media_jobs (
+    id SERIAL PRIMARY KEY,
+    message_id INTEGER NOT NULL REFERENCES messages(id),
+    kind VARCHAR(10) NOT NULL CHECK (kind IN ('image', 'voice')),
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    run_after TIMESTAMP NOT NULL DEFAULT NOW(),
+    locked_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_media_jobs_pending ON media_jobs(run_after) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_media_jobs_processing ON media_jobs(locked_at) WHERE status = 'processing';
+
+CREATE TABLE IF NOT EXISTS media_variants (
+    id SERIAL PRIMARY KEY,
+    message_id INTEGER NOT NULL REFERENCES messages(id),
+    variant VARCHAR(20) NOT NULL,
+    media_url TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    byte_size INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE(message_id, variant)
+);
+
+CREATE INDEX IF NOT EXISTS idx_media_variants_message ON media_variants(message_id, width);
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS voice_waveform SMALLINT[];
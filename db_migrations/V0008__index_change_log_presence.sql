@@ -0,0 +1,2 @@
+-- Индекс для выборки присутствия только собеседников пользователя
+CREATE INDEX IF NOT EXISTS idx_change_log_presence ON change_log(entity_id, tx_id, seq) WHERE kind = 'presence';
@@ -0,0 +1,2 @@
+-- Индекс для удаления простаивающих корзин ограничения частоты
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets(updated_at);
@@ -0,0 +1,10 @@
+-- Горизонт журнала изменений: позиция последней удалённой по сроку хранения записи
+CREATE TABLE IF NOT EXISTS change_log_horizon (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    tx_id BIGINT NOT NULL DEFAULT 0,
+    seq BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO change_log_horizon (id) VALUES (1) ON CONFLICT DO NOTHING;
+
+CREATE INDEX IF NOT EXISTS idx_change_log_created ON change_log(created_at);
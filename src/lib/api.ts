@@ -7,6 +7,19 @@ const CHATS_URL = `${API_BASE}/d5ad54d1-73a7-44c6-8c21-6c3235d63f29`;
 const FAVORITES_URL = `${API_BASE}/84354332-d4ae-48ea-a818-ca44a164982f`;
 const CALLS_URL = `${API_BASE}/calls`;
 
+// LSN последней записи: чтения после неё идут на догнавшую реплику или на основную базу
+let readAfter: string | null = null;
+
+const readHeaders = (userId: string): Record<string, string> =>
+  readAfter ? { 'X-User-Id': userId, 'X-Read-After': readAfter } : { 'X-User-Id': userId };
+
+const rememberWrite = (data: any) => {
+  if (data.readAfter) {
+    readAfter = data.readAfter;
+  }
+  return data;
+};
+
 export const api = {
   auth: {
     async login(phone: string, name: string) {
@@ -59,9 +72,7 @@ export const api = {
   chats: {
     async getAll(userId: string) {
       const response = await fetch(CHATS_URL, {
-        headers: {
-          'X-User-Id': userId,
-        },
+        headers: readHeaders(userId),
       });
       return response.json();
     },
@@ -75,7 +86,7 @@ export const api = {
         },
         body: JSON.stringify({ contactId }),
       });
-      return response.json();
+      return rememberWrite(await response.json());
     },
     
     async createGroup(userId: string, groupName: string, memberIds: string[]) {
@@ -91,16 +102,16 @@ export const api = {
           memberIds: memberIds.map(id => parseInt(id))
         }),
       });
-      return response.json();
+      return rememberWrite(await response.json());
     },
   },
 
   messages: {
     async getAll(userId: string, chatId: string) {
-      const response = await fetch(`${MESSAGES_URL}?chat_id=${chatId}`, {
-        headers: {
-          'X-User-Id': userId,
-        },
+      // Сервер отдаёт вариант медиа, который помещается в пузырь сообщения (max-w-md)
+      const maxWidth = Math.round(448 * (window.devicePixelRatio || 1));
+      const response = await fetch(`${MESSAGES_URL}?chat_id=${chatId}&max_width=${maxWidth}`, {
+        headers: readHeaders(userId),
       });
       return response.json();
     },
@@ -114,16 +125,14 @@ export const api = {
         },
         body: JSON.stringify({ chatId, text, isVoice, voiceDuration, mediaUrl, mediaType }),
       });
-      return response.json();
+      return rememberWrite(await response.json());
     },
   },
 
   contacts: {
     async getAll(userId: string) {
       const response = await fetch(CONTACTS_URL, {
-        headers: {
-          'X-User-Id': userId,
-        },
+        headers: readHeaders(userId),
       });
       return response.json();
     },
@@ -131,10 +140,9 @@ export const api = {
 
   favorites: {
     async getAll(userId: string) {
-      const response = await fetch(FAVORITES_URL, {
-        headers: {
-          'X-User-Id': userId,
-        },
+      const maxWidth = Math.round(448 * (window.devicePixelRatio || 1));
+      const response = await fetch(`${FAVORITES_URL}?max_width=${maxWidth}`, {
+        headers: readHeaders(userId),
       });
       return response.json();
     },
@@ -148,7 +156,7 @@ export const api = {
         },
         body: JSON.stringify({ messageId }),
       });
-      return response.json();
+      return rememberWrite(await response.json());
     },
 
     async remove(userId: string, messageId: string) {
@@ -158,7 +166,7 @@ export const api = {
           'X-User-Id': userId,
         },
       });
-      return response.json();
+      return rememberWrite(await response.json());
     },
   },
 